@@ -7,8 +7,16 @@ from decouple import config
 import yfinance as yf
 import pandas as pd
 from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+import functools
+import heapq
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import io
 from base64 import b64encode
 
 # Page configuration
@@ -19,6 +27,8 @@ st.set_page_config(
 )
 
 class DatabaseManager:
+    __slots__ = ('connection',)
+
     def __init__(self):
         self.connection = None
         self.connect()
@@ -29,7 +39,6 @@ class DatabaseManager:
             database_url = config('DATABASE_URL', default=None)
             if database_url:
                 self.connection = psycopg2.connect(database_url)
-                st.sidebar.success("Database connected")
             else:
                 st.error("No database connection")
                 st.stop()
@@ -117,11 +126,21 @@ class DatabaseManager:
             return False
 
 class AlpacaClient:
+    __slots__ = ('api_key', 'secret', 'base_url', 'headers', 'session')
+
     def __init__(self):
         self.api_key = "AKKVAAHKSVNYSVCNE142"
         self.secret = "zQTRsdv31D8iegqoR49LOwrXnUxRFWotl4bdJ7cQ"
         self.base_url = "https://data.alpaca.markets"  # Changed to data subdomain
         self.headers = self._get_headers()
+        # Shared session: keep-alive reuses the TLS connection across
+        # requests instead of paying a handshake per call
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', HTTPAdapter(
+            pool_maxsize=16,
+            max_retries=Retry(total=2, backoff_factor=0.3)
+        ))
     
     def _get_headers(self):
         """Create authentication headers for Alpaca API"""
@@ -180,7 +199,7 @@ class AlpacaClient:
             print(f"Debug - Headers: {self.headers}")
             print(f"Debug - Params: {params}")
             
-            response = requests.get(url, headers=self.headers, params=params)
+            response = self.session.get(url, params=params)
             print(f"Debug - Response status: {response.status_code}")
             print(f"Debug - Response text: '{response.text[:200]}...'")
             
@@ -232,7 +251,7 @@ class AlpacaClient:
             print(f"Debug - Alpaca dividend request for {symbol}: {url}")
             print(f"Debug - Params: {params}")
             
-            response = requests.get(url, headers=self.headers, params=params)
+            response = self.session.get(url, params=params)
             print(f"Debug - Response status: {response.status_code}")
             print(f"Debug - Response text: {response.text[:500]}...")
             
@@ -296,45 +315,51 @@ class AlpacaClient:
             }
 
 class YahooFinanceClient:
+    __slots__ = ()
+
     def get_stock_data(self, symbol):
         """Fallback to Yahoo Finance if Alpaca fails"""
         try:
             stock = yf.Ticker(symbol)
-            
+
             # Try to set user agent
             if hasattr(stock, 'session'):
                 stock.session.headers.update({'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'})
-            
-            info = stock.info
-            
-            # Get current price
-            current_price = (
-                info.get('currentPrice') or 
-                info.get('regularMarketPrice') or 
-                info.get('previousClose') or 
-                0
-            )
-            
-            if current_price == 0:
-                return None
-            
-            # Get dividend data
-            dividend_info = self._get_dividend_data(stock, info)
-            
-            return {
-                'symbol': symbol,
-                'price': current_price,
-                'currency': info.get('currency', 'USD'),
-                'company_name': info.get('longName', info.get('shortName', symbol)),
-                'dividend_per_share': dividend_info['dividend_per_share'],
-                'ex_date': dividend_info['ex_date'],
-                'annual_dividend': dividend_info['annual_dividend'],
-                'dividend_yield': dividend_info['dividend_yield']
-            }
-            
+
+            return self._build_stock_data(symbol, stock)
+
         except Exception as e:
             print(f"Yahoo Finance error for {symbol}: {e}")
             return None
+
+    def _build_stock_data(self, symbol, stock):
+        """Build the stock data dict from a yfinance Ticker"""
+        info = stock.info
+
+        # Get current price
+        current_price = (
+            info.get('currentPrice') or
+            info.get('regularMarketPrice') or
+            info.get('previousClose') or
+            0
+        )
+
+        if current_price == 0:
+            return None
+
+        # Get dividend data
+        dividend_info = self._get_dividend_data(stock, info)
+
+        return {
+            'symbol': symbol,
+            'price': current_price,
+            'currency': info.get('currency', 'USD'),
+            'company_name': info.get('longName', info.get('shortName', symbol)),
+            'dividend_per_share': dividend_info['dividend_per_share'],
+            'ex_date': dividend_info['ex_date'],
+            'annual_dividend': dividend_info['annual_dividend'],
+            'dividend_yield': dividend_info['dividend_yield']
+        }
     
     def _get_dividend_data(self, stock, info):
         """Extract dividend information"""
@@ -376,7 +401,10 @@ class YahooFinanceClient:
                     'dividend_yield': 0
                 }
                 
-        except Exception:
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            # Malformed or partial dividend data - treat as no dividend.
+            # Anything else (network, API) propagates to the per-symbol
+            # handlers in get_stock_data.
             return {
                 'dividend_per_share': 0,
                 'ex_date': 'N/A',
@@ -384,26 +412,389 @@ class YahooFinanceClient:
                 'dividend_yield': 0
             }
 
+class MarketRegistry:
+    """Map exchange suffixes to market metadata for multi-market support"""
+
+    MARKETS = {
+        '.L': {'market': 'London Stock Exchange', 'country': 'United Kingdom', 'currency': 'GBP'},
+        '.TO': {'market': 'Toronto Stock Exchange', 'country': 'Canada', 'currency': 'CAD'},
+        '.DE': {'market': 'XETRA', 'country': 'Germany', 'currency': 'EUR'},
+        '.PA': {'market': 'Euronext Paris', 'country': 'France', 'currency': 'EUR'},
+        '.AS': {'market': 'Euronext Amsterdam', 'country': 'Netherlands', 'currency': 'EUR'},
+        '.SW': {'market': 'SIX Swiss Exchange', 'country': 'Switzerland', 'currency': 'CHF'},
+        '.T': {'market': 'Tokyo Stock Exchange', 'country': 'Japan', 'currency': 'JPY'},
+        '.AX': {'market': 'Australian Securities Exchange', 'country': 'Australia', 'currency': 'AUD'},
+        '.HK': {'market': 'Hong Kong Stock Exchange', 'country': 'Hong Kong', 'currency': 'HKD'},
+    }
+
+    US_DEFAULT = {'market': 'US Market (NASDAQ/NYSE)', 'country': 'United States', 'currency': 'USD'}
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def get_market_info(cls, symbol):
+        """Get market metadata for a symbol based on its exchange suffix"""
+        # Single dict probe on the suffix after the last dot instead of an
+        # endswith scan over every known market
+        idx = symbol.rfind('.')
+        if idx < 0:
+            return cls.US_DEFAULT
+        return cls.MARKETS.get(symbol[idx:], cls.US_DEFAULT)
+
+    @classmethod
+    def is_uk_stock(cls, symbol):
+        """Check if symbol trades on the London Stock Exchange
+
+        Thin wrapper kept for API compatibility - derives the answer from
+        the market info instead of scanning the symbol again.
+        """
+        return cls.classify(symbol)[1]
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def classify(cls, symbol):
+        """Resolve market info and the UK flag in a single cached lookup"""
+        info = cls.get_market_info(symbol)
+        return info, info['country'] == 'United Kingdom'
+
+# Static render blobs - built once at import, not on every rerun
+_EXCEL_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+_MARKET_EXAMPLES_MD = "**Supported markets**\n\n" + "\n".join(
+    f"- `{suffix}` {info['market']} ({info['currency']})"
+    for suffix, info in MarketRegistry.MARKETS.items()
+) + "\n- US listings need no suffix (USD)"
+
 # Initialize database
 @st.cache_resource
 def get_db():
     return DatabaseManager()
 
-db = get_db()
+@st.cache_resource
+def get_market_clients():
+    """Provider clients are shared across reruns and sessions"""
+    return AlpacaClient(), YahooFinanceClient()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def get_cached_portfolio(user_id):
+    """Portfolio only changes on add/remove, so short-cache the DB read
+    instead of querying on every rerun"""
+    return get_db().get_portfolio(user_id)
+
+# Column layout for the analysis results table - rows are accumulated as
+# plain tuples and turned into a single DataFrame at the end
+ANALYSIS_COLUMNS = ['Symbol', 'Company', 'Shares', 'Price', 'Value',
+                    'Dividend', 'Yield', 'Ex-Date']
+
+# Numeric companion columns carried in the results frame for vectorized
+# aggregation but kept out of the displayed table
+ANALYSIS_META_COLUMNS = ['Currency', 'ValueNum', 'Success']
+
+# Shares stay numeric in the frame (typed Arrow column, client-side
+# sortable) and are formatted by the frontend; prices and values span
+# multiple currencies so those remain pre-formatted strings
+_RESULTS_COLUMN_CONFIG = {
+    'Shares': st.column_config.NumberColumn(format="%.1f"),
+}
+
+# Module-level constant - built once, not per format_currency call
+_CURRENCY_SYMBOLS = {
+    'USD': '$',
+    'GBP': '£',
+    'EUR': '€',
+    'JPY': '¥',
+    'CAD': 'C$',
+    'AUD': 'A$',
+    'HKD': 'HK$',
+}
+
+@functools.lru_cache(maxsize=64)
+def _currency_fmt_spec(currency, is_uk_stock):
+    """Resolve a bound format callable for a currency once per combination"""
+    if currency == 'GBP' and is_uk_stock:
+        return "{:.1f}p".format  # UK stocks in pence
+    symbol = _CURRENCY_SYMBOLS.get(currency)
+    if symbol:
+        return (symbol + "{:.2f}").format
+    return (currency + " {:.2f}").format
 
 def format_currency(amount, currency, is_uk_stock=False):
     """Format currency properly"""
-    if currency == 'GBP' and is_uk_stock:
-        return f"{amount:.1f}p"  # UK stocks in pence
-    elif currency == 'GBP':
-        return f"£{amount:.2f}"
-    elif currency == 'USD':
-        return f"${amount:.2f}"
-    else:
-        return f"{currency} {amount:.2f}"
+    return _currency_fmt_spec(currency, is_uk_stock)(amount)
+
+def portfolio_fingerprint(portfolio):
+    """Content hash of the portfolio used to key cached analysis artifacts"""
+    return hash(tuple((item['symbol'], float(item['shares'])) for item in portfolio))
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_stock_data(symbol, is_uk):
+    """Per-symbol quote fetch, cached for 5 minutes across reruns"""
+    alpaca_client, yahoo_client = get_market_clients()
+    stock_data = yahoo_client.get_stock_data(symbol)
+    if stock_data:
+        stock_data['source'] = 'Yahoo Finance'
+        return stock_data
+    if is_uk:
+        # Alpaca only carries US listings, so there is no second source
+        return None
+    print(f"Yahoo Finance failed for US stock {symbol}, trying Alpaca...")
+    stock_data = alpaca_client.get_stock_data(symbol)
+    if stock_data:
+        stock_data['source'] = 'Alpaca'
+    return stock_data
+
+def build_analysis(portfolio):
+    """Fetch market data for the portfolio and build the results artifacts"""
+    rows = []
+
+    # Every symbol goes through the cached per-symbol fetch, fanned out
+    # over a thread pool - the work is all network I/O, so wall time is
+    # roughly the slowest request instead of the sum, and the 5-minute
+    # quote cache absorbs reruns between portfolio changes
+    symbols = [item['symbol'] for item in portfolio]
+    batch_data = {}
+
+    if symbols:
+        # Coarse progress updates - every widget mutation is a WebSocket
+        # message, so update at ~5% steps rather than every symbol; the
+        # bar only exists while there are fetches to track
+        progress_bar = st.progress(0.0)
+        last_update = 0.0
+        with ThreadPoolExecutor(max_workers=min(16, len(symbols))) as executor:
+            futures = {
+                executor.submit(fetch_stock_data, s, MarketRegistry.is_uk_stock(s)): s
+                for s in symbols
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                symbol = futures[future]
+                try:
+                    stock_data = future.result()
+                    if stock_data:
+                        batch_data[symbol] = stock_data
+                except Exception as e:
+                    print(f"Fetch failed for {symbol}: {e}")
+                # Cap UI updates at ~20 Hz regardless of how fast
+                # futures resolve; always push the final state
+                now = time.monotonic()
+                if now - last_update >= 0.05 or done == len(symbols):
+                    progress_bar.progress(done / len(symbols))
+                    last_update = now
+        progress_bar.empty()
+
+    # Formatting pass - pure local work, result order follows the portfolio.
+    # Summary metrics are fused into this single pass rather than
+    # re-scanning the results once per metric.
+    source_counts = Counter()
+
+    for item in portfolio:
+        symbol = item['symbol']
+        # Every display-ready string is computed here, once per analysis,
+        # so the render path does zero formatting on rerun
+        shares = float(item['shares'])
+
+        # One cached lookup per symbol instead of repeated suffix checks
+        is_uk_stock = MarketRegistry.is_uk_stock(symbol)
+        stock_data = batch_data.get(symbol)
+
+        if stock_data:
+            source_counts[stock_data.get('source', 'Yahoo Finance')] += 1
+            currency = stock_data['currency']
+
+            # Calculate dividend yield if not provided
+            if stock_data['dividend_yield'] == 0 and stock_data['annual_dividend'] > 0:
+                stock_data['dividend_yield'] = (stock_data['annual_dividend'] / stock_data['price'] * 100)
+
+            # Compute the raw numerics once, then format - nothing
+            # downstream ever parses a display string back to a number
+            uk_in_pence = is_uk_stock and currency == 'GBP'
+            if uk_in_pence:
+                # UK quotes arrive in pence; keep values in pounds
+                price_units = stock_data['price'] / 100
+            else:
+                price_units = stock_data['price']
+            position_value = shares * price_units
+
+            if uk_in_pence:
+                price_display = f"£{price_units:.2f}"
+                value_display = f"£{position_value:.2f}"
+            else:
+                price_display = format_currency(price_units, currency)
+                value_display = format_currency(position_value, currency)
+
+            # Format dividend
+            if stock_data['dividend_per_share'] > 0:
+                if uk_in_pence:
+                    # Convert dividend from pence to pounds
+                    dividend_in_pounds = stock_data['dividend_per_share'] / 100
+                    dividend_display = f"£{dividend_in_pounds:.3f}"
+                else:
+                    dividend_display = format_currency(stock_data['dividend_per_share'], currency)
+
+                yield_display = f"{stock_data['dividend_yield']:.2f}%"
+            else:
+                dividend_display = "No dividend"
+                yield_display = "0%"
+
+            rows.append((
+                symbol,
+                stock_data['company_name'][:30],
+                shares,
+                price_display,
+                value_display,
+                dividend_display,
+                yield_display,
+                stock_data['ex_date'],
+                currency,
+                position_value,
+                True
+            ))
+        else:
+            rows.append((
+                symbol,
+                'Data unavailable',
+                shares,
+                'N/A',
+                'N/A',
+                'N/A',
+                'N/A',
+                'N/A',
+                None,
+                0.0,
+                False
+            ))
+
+    df = pd.DataFrame.from_records(rows, columns=ANALYSIS_COLUMNS + ANALYSIS_META_COLUMNS)
+    # Per-currency totals in one vectorized pass over the numeric column
+    total_value = df.groupby('Currency')['ValueNum'].sum().to_dict()
+    # Outcome tallies come from the boolean Success column - one
+    # numpy-backed sum instead of per-row Python counters
+    successful = int(df['Success'].sum())
+    summary = {
+        'successful': successful,
+        'failed': len(df) - successful,
+        'source_counts': dict(source_counts),
+    }
+    return {'df': df, 'total_value': total_value, 'summary': summary}
+
+def _build_export_payloads(artifacts):
+    """Build the Excel and CSV download payloads into the artifacts"""
+    df = artifacts['df']
+
+    buffer = io.BytesIO()
+    # constant_memory streams rows out instead of building the
+    # whole workbook object tree in RAM
+    with pd.ExcelWriter(buffer, engine='xlsxwriter',
+                        engine_kwargs={'options': {'constant_memory': True}}) as writer:
+        df[ANALYSIS_COLUMNS].to_excel(writer, sheet_name='Portfolio', index=False)
+    artifacts['excel_bytes'] = buffer.getvalue()
+
+    # Write the CSV through a buffer in chunks rather than building
+    # one large intermediate string
+    csv_buffer = io.BytesIO()
+    df[ANALYSIS_COLUMNS].to_csv(csv_buffer, index=False, encoding='utf-8', chunksize=1024)
+    artifacts['csv_bytes'] = csv_buffer.getvalue()
+
+def display_large_dataframe(df, page_size=50, column_config=None):
+    """Render a DataFrame one page at a time
+
+    st.dataframe serializes the whole frame to the browser on every
+    rerun, so for large portfolios only the visible slice is sent.
+    Small frames render directly to keep the UX simple.
+    """
+    total_rows = len(df)
+    if total_rows <= page_size:
+        st.dataframe(df, width='stretch', column_config=column_config)
+        return
+
+    col1, col2 = st.columns(2)
+    with col1:
+        size = st.selectbox("Rows per page", (25, 50, 100), index=1,
+                            key="results_page_size")
+    pages = -(-total_rows // size)
+    with col2:
+        page = st.number_input("Page", min_value=1, max_value=pages, value=1,
+                               key="results_page")
+
+    start = (page - 1) * size
+    end = min(start + size, total_rows)
+    st.dataframe(df.iloc[start:end], width='stretch', column_config=column_config)
+    st.caption(f"Showing rows {start + 1}-{end} of {total_rows}")
+
+@st.fragment
+def display_analysis(artifacts):
+    """Render cached analysis artifacts - no fetching or number crunching
+
+    Runs as a fragment so interactions inside the results panel (e.g. the
+    download buttons) rerun only this subtree, not the whole script.
+    """
+    df = artifacts['df']
+    total_value = artifacts['total_value']
+
+    if df.empty:
+        return
+
+    # Summary metrics - all precomputed in build_analysis' single pass
+    summary = artifacts['summary']
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Stocks", len(df))
+    col2.metric("With data", summary['successful'])
+    col3.metric("Unavailable", summary['failed'])
+
+    # One markdown block for all sources (sorted busiest-first) instead
+    # of a separate st.info widget per provider
+    if summary['source_counts']:
+        lines = [
+            f"> **{source}**: retrieved data for {count} stocks"
+            for source, count in sorted(summary['source_counts'].items(),
+                                        key=lambda kv: -kv[1])
+        ]
+        st.markdown("\n\n".join(lines))
+
+    display_large_dataframe(df[ANALYSIS_COLUMNS],
+                            column_config=_RESULTS_COLUMN_CONFIG)
+
+    # Portfolio totals - only the three largest currency buckets get a
+    # line; nlargest picks them without sorting the whole breakdown
+    st.subheader("Portfolio Total")
+    for currency, value in heapq.nlargest(3, total_value.items(),
+                                          key=lambda kv: kv[1]):
+        if currency == 'GBP':
+            st.write(f"GBP Holdings: £{value:.2f}")
+        elif currency == 'USD':
+            st.write(f"USD Holdings: ${value:.2f}")
+        else:
+            st.write(f"{currency} Holdings: {value:.2f}")
+    if len(total_value) > 3:
+        st.caption(f"+{len(total_value) - 3} smaller currency holdings")
+
+    # Export - payloads are only built when the user asks for them, then
+    # cached in the artifacts so repeat clicks reuse the same bytes
+    st.subheader("Export")
+    if 'excel_bytes' not in artifacts:
+        if not st.button("Prepare export files"):
+            return
+        _build_export_payloads(artifacts)
+
+    export_date = date.today().strftime('%Y%m%d')
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.download_button(
+            "Download Excel",
+            data=artifacts['excel_bytes'],
+            file_name=f"dividend_portfolio_{export_date}.xlsx",
+            mime=_EXCEL_MIME
+        )
+
+    with col2:
+        st.download_button(
+            "Download CSV",
+            data=artifacts['csv_bytes'],
+            file_name=f"dividend_portfolio_{export_date}.csv",
+            mime='text/csv'
+        )
 
 def login_page():
     """Display login page"""
+    db = get_db()
     st.title("Login")
     
     tab1, tab2 = st.tabs(["Login", "Sign Up"])
@@ -422,7 +813,8 @@ def login_page():
                     st.session_state.username = user['username']
                     st.query_params['user'] = user['username']
                     st.query_params['session'] = 'active'
-                    st.success("Login successful!")
+                    # Toast survives the rerun; st.success would be wiped
+                    st.toast(f"Welcome back, {user['username']}!", icon="👋")
                     st.rerun()
                 else:
                     st.error("Invalid username or password")
@@ -446,10 +838,95 @@ def login_page():
                     if db.create_user(new_username, new_password, new_email):
                         st.success("Account created! Please login.")
 
+@st.fragment
+def render_portfolio_sidebar(user_id):
+    """Sidebar portfolio management, isolated as a fragment
+
+    Typing in the form or toggling the expander reruns only this
+    subtree; mutations rerun the whole app since the analysis panel
+    depends on the portfolio.
+    """
+    db = get_db()
+    st.header("Portfolio Management")
+
+    # Add stock form
+    with st.form("add_stock"):
+        st.subheader("Add Stock")
+        symbol_raw = st.text_input("Symbol (e.g., AAPL, MSFT)")
+        shares = st.number_input("Shares", min_value=0.1, value=1.0, step=0.1)
+        add_button = st.form_submit_button("Add Stock")
+
+        if add_button and symbol_raw:
+            # Normalize only on submit - no point allocating new strings
+            # on the reruns where the form just sits there
+            symbol = symbol_raw.upper().strip()
+            if symbol and db.add_stock(user_id, symbol, shares):
+                get_cached_portfolio.clear()
+                # Toast survives the rerun, so no need to delay it
+                st.toast(f"Added {shares} shares of {symbol}", icon="✅")
+                st.rerun(scope="app")
+
+    with st.expander("Market examples"):
+        st.markdown(_MARKET_EXAMPLES_MD)
+
+    # Display portfolio
+    st.subheader("Current Portfolio")
+    portfolio = get_cached_portfolio(user_id)
+
+    # Single status line instead of one widget per status message
+    st.caption(f"📈 {len(portfolio)} stocks · 💾 DB connected")
+
+    if portfolio:
+        # One editable grid instead of two widgets per row - delete a
+        # row to remove the stock, edit shares inline to update
+        df_portfolio = pd.DataFrame(portfolio)[['symbol', 'shares']]
+        df_portfolio['shares'] = df_portfolio['shares'].astype(float)
+        edited = st.data_editor(
+            df_portfolio,
+            num_rows="dynamic",
+            hide_index=True,
+            key=f"portfolio_editor_{user_id}"
+        )
+
+        original = {item['symbol']: float(item['shares']) for item in portfolio}
+        # Compare in the same normalized form the save loop uses, so a
+        # case-only edit of a row is an update, not a deletion
+        edited_symbols = {
+            str(s).upper().strip() for s in edited['symbol'].dropna()
+        }
+        changed = False
+
+        for symbol in original:
+            if symbol not in edited_symbols:
+                if db.remove_stock(user_id, symbol):
+                    st.toast(f"Removed {symbol}", icon="🗑️")
+                    changed = True
+
+        for row in edited.itertuples(index=False):
+            if not row.symbol or pd.isna(row.shares):
+                continue
+            row_symbol = str(row.symbol).upper().strip()
+            row_shares = float(row.shares)
+            if original.get(row_symbol) != row_shares:
+                if db.add_stock(user_id, row_symbol, row_shares):
+                    st.toast(f"Saved {row_shares} shares of {row_symbol}", icon="✅")
+                    changed = True
+
+        if changed:
+            get_cached_portfolio.clear()
+            st.rerun(scope="app")
+    else:
+        st.write("No stocks in portfolio")
+
 def main_app():
     """Main application"""
+    # Bind session values once instead of hitting the session-state proxy
+    # on every use below
+    user_id = st.session_state.user_id
+    username = st.session_state.username
+
     st.title("Dividend Tracker")
-    st.write(f"Welcome, {st.session_state.username}!")
+    st.write(f"Welcome, {username}!")
     
     # Logout button - Fixed to clear session properly
     if st.button("Logout"):
@@ -458,147 +935,39 @@ def main_app():
             del st.session_state[key]
         # Clear query params
         st.query_params.clear()
-        st.success("Logged out successfully!")
+        st.toast("Logged out successfully", icon="👋")
         st.rerun()
     
     # Sidebar for portfolio management
     with st.sidebar:
-        st.header("Portfolio Management")
-        
-        # Add stock form
-        with st.form("add_stock"):
-            st.subheader("Add Stock")
-            symbol = st.text_input("Symbol (e.g., AAPL, MSFT)").upper().strip()
-            shares = st.number_input("Shares", min_value=0.1, value=1.0, step=0.1)
-            add_button = st.form_submit_button("Add Stock")
-            
-            if add_button and symbol:
-                if db.add_stock(st.session_state.user_id, symbol, shares):
-                    st.success(f"Added {shares} shares of {symbol}")
-                    st.rerun()
-        
-        # Display portfolio
-        st.subheader("Current Portfolio")
-        portfolio = db.get_portfolio(st.session_state.user_id)
-        
-        if portfolio:
-            for item in portfolio:
-                col1, col2 = st.columns([3, 1])
-                with col1:
-                    st.write(f"{item['symbol']}: {item['shares']}")
-                with col2:
-                    if st.button("X", key=f"remove_{item['symbol']}"):
-                        if db.remove_stock(st.session_state.user_id, item['symbol']):
-                            st.success(f"Removed {item['symbol']}")
-                            st.rerun()
-        else:
-            st.write("No stocks in portfolio")
+        render_portfolio_sidebar(user_id)
     
     # Main content area
-    portfolio = db.get_portfolio(st.session_state.user_id)
-    
+    portfolio = get_cached_portfolio(user_id)
+
     if portfolio:
         st.subheader("Portfolio Analysis")
-        
-        alpaca_client = AlpacaClient()
-        yahoo_client = YahooFinanceClient()
-        table_data = []
-        total_value = {}
-        
-        for item in portfolio:
-            # Test Alpaca API with fixed endpoint, fallback to Yahoo Finance
-            if item['symbol'].endswith('.L'):
-                print(f"UK stock {item['symbol']} - using Yahoo Finance directly")
-                stock_data = yahoo_client.get_stock_data(item['symbol'])
-            else:
-                print(f"US stock {item['symbol']} - trying Alpaca first")
-                stock_data = alpaca_client.get_stock_data(item['symbol'])
-                
-                if not stock_data:
-                    print(f"Alpaca failed for {item['symbol']}, trying Yahoo Finance...")
-                    stock_data = yahoo_client.get_stock_data(item['symbol'])
-            
-            if stock_data:
-                is_uk_stock = item['symbol'].endswith('.L')
-                currency = stock_data['currency']
-                
-                # Calculate dividend yield if not provided
-                if stock_data['dividend_yield'] == 0 and stock_data['annual_dividend'] > 0:
-                    stock_data['dividend_yield'] = (stock_data['annual_dividend'] / stock_data['price'] * 100)
-                
-                # Format price and value for UK stocks
-                if is_uk_stock and currency == 'GBP':
-                    # Convert pence to pounds for display
-                    price_in_pounds = stock_data['price'] / 100
-                    price_display = f"£{price_in_pounds:.2f}"
-                    # Calculate position value in pounds
-                    position_value = float(item['shares']) * price_in_pounds
-                    value_display = f"£{position_value:.2f}"
-                    # Store actual pounds value for totals
-                    portfolio_value = position_value
-                else:
-                    price_display = format_currency(stock_data['price'], currency)
-                    position_value = float(item['shares']) * stock_data['price']
-                    value_display = format_currency(position_value, currency)
-                    portfolio_value = position_value
-                
-                # Format dividend
-                if stock_data['dividend_per_share'] > 0:
-                    if is_uk_stock and currency == 'GBP':
-                        # Convert dividend from pence to pounds
-                        dividend_in_pounds = stock_data['dividend_per_share'] / 100
-                        dividend_display = f"£{dividend_in_pounds:.3f}"
-                    else:
-                        dividend_display = format_currency(stock_data['dividend_per_share'], currency)
-                    
-                    yield_display = f"{stock_data['dividend_yield']:.2f}%"
-                else:
-                    dividend_display = "No dividend"
-                    yield_display = "0%"
-                
-                # Track totals by currency (use portfolio_value which is already in correct units)
-                if currency not in total_value:
-                    total_value[currency] = 0
-                
-                total_value[currency] += portfolio_value
-                
-                table_data.append({
-                    'Symbol': item['symbol'],
-                    'Company': stock_data['company_name'][:30],
-                    'Shares': f"{float(item['shares']):.1f}",
-                    'Price': price_display,
-                    'Value': value_display,
-                    'Dividend': dividend_display,
-                    'Yield': yield_display,
-                    'Ex-Date': stock_data['ex_date']
-                })
-            else:
-                table_data.append({
-                    'Symbol': item['symbol'],
-                    'Company': 'Data unavailable',
-                    'Shares': f"{float(item['shares']):.1f}",
-                    'Price': 'N/A',
-                    'Value': 'N/A',
-                    'Dividend': 'N/A',
-                    'Yield': 'N/A',
-                    'Ex-Date': 'N/A'
-                })
-        
-        # Display table
-        if table_data:
-            df = pd.DataFrame(table_data)
-            st.dataframe(df, width='stretch')
-            
-            # Portfolio totals
-            st.subheader("Portfolio Total")
-            for currency, value in total_value.items():
-                if currency == 'GBP':
-                    st.write(f"GBP Holdings: £{value:.2f}")
-                elif currency == 'USD':
-                    st.write(f"USD Holdings: ${value:.2f}")
-                else:
-                    st.write(f"{currency} Holdings: {value:.2f}")
-    
+
+        # Quotes are cached (5 min TTL on the per-symbol fetch, plus the
+        # artifacts hash below) - give the user a manual override
+        if st.button("🔄 Refresh data"):
+            fetch_stock_data.clear()
+            st.session_state.pop('analysis_hash', None)
+            st.session_state.pop('analysis_artifacts', None)
+            st.rerun()
+
+        # Skip the whole fetch/format pass when the portfolio is unchanged -
+        # the rendered artifacts are keyed by a content hash in session state
+        current_hash = portfolio_fingerprint(portfolio)
+        if (st.session_state.get('analysis_hash') != current_hash
+                or 'analysis_artifacts' not in st.session_state):
+            artifacts = build_analysis(portfolio)
+            st.session_state.analysis_hash = current_hash
+            st.session_state.analysis_artifacts = artifacts
+        else:
+            artifacts = st.session_state.analysis_artifacts
+
+        display_analysis(artifacts)
     else:
         st.info("Add stocks to your portfolio using the sidebar to get started!")
 
@@ -613,7 +982,7 @@ def main():
         query_params = st.query_params
         if 'user' in query_params and 'session' in query_params:
             username = query_params['user']
-            user = db.get_user(username)
+            user = get_db().get_user(username)
             if user:
                 st.session_state.authenticated = True
                 st.session_state.user_id = user['id']